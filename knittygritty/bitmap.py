@@ -1,4 +1,3 @@
-from PIL import Image
 from os import path
 
 from kh940 import Pattern
@@ -14,7 +13,11 @@ INV_COLOR_MAP = {
 }
 
 
+# PIL is imported in the functions using it to keep CLI startup fast
+
 def write_pattern(pattern, filename):
+    from PIL import Image
+
     image = Image.new('RGB', (pattern.width, pattern.height))
 
     for y, row in enumerate(pattern.rows):
@@ -25,6 +28,8 @@ def write_pattern(pattern, filename):
 
 
 def read_pattern(filename):
+    from PIL import Image
+
     image = Image.open(filename)
     width, height = image.size
 
@@ -1,7 +1,7 @@
 import base64
 import json
 
-from serial import Serial
+from recording import RecordingPort
 
 
 class Sector(object):
@@ -57,6 +57,22 @@ class Disk(object):
 
         return -1
 
+    @classmethod
+    def from_bytes(cls, data):
+        '''Build a disk from the output of `to_bytes`'''
+        disk = cls()
+        size = Sector.SECTOR_ID_LENGTH + Sector.DATA_LENGTH
+
+        disk.sectors = [Sector(data[i:i + Sector.SECTOR_ID_LENGTH],
+                               data[i + Sector.SECTOR_ID_LENGTH:i + size])
+                        for i in range(0, len(data), size)]
+
+        return disk
+
+    def to_bytes(self):
+        '''All sector IDs and data, for storing the disk in a recording'''
+        return ''.join(sector.sector_id + sector.data for sector in self.sectors)
+
     def concat_sectors(self, count=SECTOR_COUNT):
         data = ''
 
@@ -89,23 +105,107 @@ class Disk(object):
             json.dump(data, f, indent=2)
 
 
+class DiskBanks(object):
+    '''A set of named, preloaded disks of which one is served at a time.
+
+    Switching hands the new disk to the server, which starts serving it
+    when the machine begins its next transfer. Nothing is rebuilt.'''
+
+    def __init__(self, server, banks):
+        self.server = server
+        self.names = [name for name, disk in banks]
+        self.disks = dict(banks)
+
+        if len(self.disks) != len(self.names):
+            raise ValueError('Bank names must be unique')
+
+        self.active = self.names[0]
+
+        if self.server.disk is not self.disks[self.active]:
+            self.server.set_disk(self.disks[self.active])
+
+    def switch(self, name):
+        if name not in self.disks:
+            raise KeyError('Unknown bank %s' % name)
+
+        self.server.switch_disk(self.disks[name])
+        self.active = name
+
+    def serve_control(self, port):
+        import socket
+        import threading
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', port))
+        listener.listen(1)
+
+        thread = threading.Thread(target=self._control_loop, args=(listener,))
+        thread.daemon = True
+        thread.start()
+
+    def _control_loop(self, listener):
+        while True:
+            conn, _ = listener.accept()
+
+            try:
+                name = conn.makefile().readline().strip()
+
+                try:
+                    self.switch(name)
+                except KeyError as e:
+                    conn.sendall('ERROR %s\n' % e.args[0])
+                else:
+                    print 'Serving bank %s from the next transfer' % name
+                    conn.sendall('OK %s\n' % name)
+            finally:
+                conn.close()
+
+
+def send_bank_switch(name, port):
+    import socket
+
+    conn = socket.create_connection(('127.0.0.1', port))
+
+    try:
+        conn.sendall(name + '\n')
+        return conn.makefile().readline().strip()
+    finally:
+        conn.close()
+
+
 class FDCServer(object):
     MODE_OP = 'op'
     MODE_FDC = 'fdc'
 
-    def __init__(self, port, disk):
-        self.port = Serial(port=port,
-                           baudrate=9600,
-                           parity='N',
-                           stopbits=1,
-                           timeout=1,
-                           xonxoff=0,
-                           rtscts=0,
-                           dsrdtr=0)
-        self.disk = disk
+    def __init__(self, port, disk, record_filename=None):
+        if isinstance(port, basestring):
+            from serial import Serial
+
+            serial_port = Serial(port=port,
+                                 baudrate=9600,
+                                 parity='N',
+                                 stopbits=1,
+                                 timeout=1,
+                                 xonxoff=0,
+                                 rtscts=0,
+                                 dsrdtr=0)
+
+            if not serial_port:
+                raise IOError('Could not open serial device %s' % port)
+
+            port = serial_port
+
+        self.recorder = None
+        if record_filename:
+            port = self.recorder = RecordingPort(port, record_filename)
 
-        if not self.port:
-            raise IOError('Could not open serial device %s' % port)
+        self.port = port
+        self.set_disk(disk)
+
+        # Disks queued by switch_disk from other threads, applied by the
+        # serving thread when the machine starts a transfer
+        self.pending_disks = []
 
         self.port.setRTS(True)
 
@@ -114,6 +214,26 @@ class FDCServer(object):
     def close(self):
         self.port.close()
 
+    def set_disk(self, disk):
+        self.disk = disk
+
+        if self.recorder:
+            self.recorder.log_disk(disk.to_bytes())
+
+    def switch_disk(self, disk):
+        '''Serve `disk` from the start of the next transfer. Safe to call
+        from another thread while the server is running.'''
+        self.pending_disks.append(disk)
+
+    def _apply_pending_disk(self):
+        disk = None
+
+        while self.pending_disks:
+            disk = self.pending_disks.pop(0)
+
+        if disk is not None:
+            self.set_disk(disk)
+
     def run(self):
         while True:
             self.step()
@@ -147,6 +267,12 @@ class FDCServer(object):
 
         print 'got %s %s' % (req_cmd, req_args)
 
+        # Transfers start with the ID section of sector 0, so a switched disk
+        # is never mixed with the previous one within a load or save
+        if (req_cmd in ('A', 'B', 'C') and len(req_args) == 1
+                and int(req_args[0], 10) == 0):
+            self._apply_pending_disk()
+
         if req_cmd == 'A':
             self.step_fdc_read_id_section(req_args)
         elif req_cmd == 'S':
@@ -1,5 +1,6 @@
 from collections import namedtuple
 
+import binascii
 import math
 import struct
 
@@ -32,6 +33,20 @@ def _memo_size(height):
     return int(math.ceil(height / 2.0))
 
 
+# The memo holds one nibble per row, laid out like the stitch rows with a
+# padding nibble first for patterns of odd height
+
+def _unpack_memo(height, memo):
+    return list(util.to_nibbles(memo))[util.padding(height, 2):]
+
+
+def _pack_memo(values, pad_nibble=0):
+    if not all(0 <= v <= 0xf for v in values):
+        raise ValueError('Memo values must be between 0 and 15')
+
+    return util.from_nibbles([pad_nibble] * util.padding(len(values), 2) + list(values))
+
+
 def _pattern_data_sizes(width, height):
     row_nibbles = int(math.ceil(width / 4.0))
     row_pad_bits = util.padding(width, 4)
@@ -41,26 +56,55 @@ def _pattern_data_sizes(width, height):
     return row_nibbles, row_pad_bits, initial_padding
 
 
-def _parse_pattern_rows(width, height, data):
+def _parse_packed_rows(width, height, data):
     row_nibbles, row_pad_bits, initial_padding = _pattern_data_sizes(width, height)
 
-    nibble_data = list(util.to_nibbles(data))
+    value = int(binascii.hexlify(data), 16)
 
-    rows = []
+    row_bits = row_nibbles * 4
+    row_mask = _row_mask(width)
 
-    for row in range(height):
-        start_index = initial_padding + row_nibbles * row
-        end_index = start_index + row_nibbles
+    # Padding bits above the width are dropped, like the machine does
+    return [(value >> (row_bits * (height - 1 - row))) & row_mask
+            for row in range(height)]
 
-        bits = list(util.nibble_bits(nibble_data[start_index:end_index]))
 
-        rows.append([bool(b) for b in reversed(bits[row_pad_bits:])])
+def _serialize_packed_rows(width, height, packed_rows):
+    row_nibbles, row_pad_bits, initial_padding = _pattern_data_sizes(width, height)
 
-    return rows
+    row_bits = row_nibbles * 4
+    value = 0
 
+    for row in packed_rows:
+        value = (value << row_bits) | row
+
+    return binascii.unhexlify('%0*x' % (initial_padding + row_nibbles * height, value))
+
+
+def _pack_row(row):
+    return int(''.join('1' if b else '0' for b in reversed(row)), 2)
+
+
+def _unpack_row(width, packed_row):
+    return [c == '1' for c in reversed(format(packed_row, '0%sb' % width))]
 
-def _read_pattern(data, header_idx):
-    header = data[header_idx * 7:(header_idx + 1) * 7]
+
+def _row_mask(width):
+    return (1 << width) - 1
+
+
+PatternLocation = namedtuple('PatternLocation', [
+    'pattern_number',
+    'width',
+    'height',
+    'pattern_start',
+    'memo_start',
+    'memo_end',
+])
+
+
+def _read_pattern_location(data, header_idx):
+    header = str(data[header_idx * 7:(header_idx + 1) * 7])
 
     end_offset = struct.unpack('>H', header[0:2])[0]
     data_nibbles = list(util.to_nibbles(header[2:]))
@@ -74,17 +118,34 @@ def _read_pattern(data, header_idx):
     memo_end_pos = 0x7fff - end_offset
     memo_start_pos = memo_end_pos - memo_size
 
-    memo = data[memo_start_pos + 1:memo_end_pos + 1]
-
     pattern_size = int(math.ceil(math.ceil(width / 4.0) * height / 2.0))
     pattern_end_pos = memo_start_pos
     pattern_start_pos = pattern_end_pos - pattern_size
 
-    pattern = data[pattern_start_pos + 1:pattern_end_pos + 1]
+    return PatternLocation(ptn_num, width, height,
+                           pattern_start_pos + 1,
+                           memo_start_pos + 1,
+                           memo_end_pos + 1)
+
+
+def _read_pattern(data, header_idx):
+    location = _read_pattern_location(data, header_idx)
+
+    if not location:
+        return None
+
+    memo = data[location.memo_start:location.memo_end]
+    pattern = data[location.pattern_start:location.memo_start]
+
+    packed_rows = _parse_packed_rows(location.width, location.height, pattern)
+
+    return Pattern.from_packed_rows(location.pattern_number, location.width, packed_rows, memo)
+
 
-    parsed = _parse_pattern_rows(width, height, pattern)
+def _pattern_digest(width, height, row_data):
+    import hashlib
 
-    return Pattern(ptn_num, parsed, memo)
+    return hashlib.sha1('%s,%s:%s' % (width, height, row_data)).hexdigest()
 
 
 def _read_data0(data):
@@ -111,9 +172,18 @@ def _read_data2(data):
 
 
 class Pattern(object):
+    '''A pattern of `width` x `height` stitches.
+
+    Stitches are available both as `rows`, lists of booleans, and as
+    `packed_rows`, one integer per row with stitch x in bit x. Whichever
+    form a pattern was not created from is built on first use, so patterns
+    should not be modified in place. The transform methods work on packed
+    rows and return new patterns with the same number and an empty memo.'''
+
     def __init__(self, pattern_number, rows, memo=None):
         self.pattern_number = pattern_number
-        self.rows = rows
+        self._rows = rows
+        self._packed_rows = None
         self.height = len(rows)
 
         assert self.height > 0
@@ -125,19 +195,228 @@ class Pattern(object):
 
         assert len(self.memo) == _memo_size(self.height)
 
+    @classmethod
+    def from_packed_rows(cls, pattern_number, width, packed_rows, memo=None):
+        pattern = cls.__new__(cls)
+        pattern.pattern_number = pattern_number
+        pattern._rows = None
+        pattern._packed_rows = list(packed_rows)
+        pattern.height = len(packed_rows)
+        pattern.width = width
+
+        assert pattern.height > 0 and width > 0
+        assert all(0 <= row <= _row_mask(width) for row in packed_rows)
+
+        pattern.memo = memo or ('\x00' * _memo_size(pattern.height))
+
+        assert len(pattern.memo) == _memo_size(pattern.height)
+
+        return pattern
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = [_unpack_row(self.width, row) for row in self._packed_rows]
+
+        return self._rows
+
+    @property
+    def packed_rows(self):
+        if self._packed_rows is None:
+            self._packed_rows = [_pack_row(row) for row in self._rows]
+
+        return self._packed_rows
+
     def __repr__(self):
         return '<Pattern #%s (%sx%s)>' % (self.pattern_number, self.width, self.height)
 
-    def _serialize_rows(self):
-        row_nibbles, row_pad_bits, initial_padding = _pattern_data_sizes(self.width, self.height)
+    @property
+    def memo_rows(self):
+        '''The memo value (0-15) of each row, top row first'''
+        return _unpack_memo(self.height, self.memo)
+
+    @memo_rows.setter
+    def memo_rows(self, values):
+        if len(values) != self.height:
+            raise ValueError('Expected %s memo values, got %s' % (self.height, len(values)))
+
+        self.memo = _pack_memo(values)
 
-        bits = [0] * (initial_padding * 4)
+    def set_memo_row(self, row, value):
+        if not 0 <= row < self.height:
+            raise IndexError('Row %s is outside %r' % (row, self))
 
-        for row in self.rows:
-            bits += [0] * row_pad_bits
-            bits += [int(b) for b in reversed(row)]
+        if not 0 <= value <= 0xf:
+            raise ValueError('Memo values must be between 0 and 15')
 
-        return util.bits_to_bytes(bits)
+        index = util.padding(self.height, 2) + row
+        byte_index = index // 2
+        old = ord(self.memo[byte_index])
+
+        if index % 2:
+            new = (old & 0xf0) | value
+        else:
+            new = (old & 0x0f) | (value << 4)
+
+        self.memo = self.memo[:byte_index] + chr(new) + self.memo[byte_index + 1:]
+
+    def _transformed(self, width, packed_rows):
+        return Pattern.from_packed_rows(self.pattern_number, width, packed_rows)
+
+    def invert(self):
+        '''Swap set and unset stitches
+
+        >>> Pattern(1, [[True, False, False], [True, True, False]]).invert().rows
+        [[False, True, True], [False, False, True]]
+        '''
+        mask = _row_mask(self.width)
+
+        return self._transformed(self.width, [row ^ mask for row in self.packed_rows])
+
+    def mirror(self):
+        '''Mirror left to right
+
+        >>> Pattern(1, [[True, False, False], [True, True, False]]).mirror().rows
+        [[False, False, True], [False, True, True]]
+        '''
+        fmt = '0%sb' % self.width
+
+        return self._transformed(self.width, [int(format(row, fmt)[::-1], 2)
+                                              for row in self.packed_rows])
+
+    def flip(self):
+        '''Mirror top to bottom
+
+        >>> Pattern(1, [[True, False, False], [True, True, False]]).flip().rows
+        [[True, True, False], [True, False, False]]
+        '''
+        return self._transformed(self.width, self.packed_rows[::-1])
+
+    def rotate(self, turns=1):
+        '''Rotate clockwise by `turns` quarter turns
+
+        >>> pattern = Pattern(1, [[True, False, False], [True, True, False]])
+        >>> pattern.rotate().rows
+        [[True, True], [True, False], [False, False]]
+        >>> pattern.rotate(-1).rows
+        [[False, False], [False, True], [True, True]]
+        '''
+        turns %= 4
+
+        if turns == 0:
+            return self._transformed(self.width, self.packed_rows)
+        elif turns == 2:
+            return self.mirror().flip()
+        elif turns == 3:
+            return self.rotate(1).rotate(2)
+
+        fmt = '0%sb' % self.width
+        bit_strings = [format(row, fmt) for row in reversed(self.packed_rows)]
+
+        # Columns of the bottom-up rows, rightmost first, are the rotated
+        # rows with their leftmost stitch as the most significant bit
+        columns = zip(*bit_strings)[::-1]
+
+        return self._transformed(self.height, [int(''.join(column)[::-1], 2)
+                                               for column in columns])
+
+    def crop(self, x, y, width, height):
+        '''Cut out `width` x `height` stitches starting at (`x`, `y`)
+
+        >>> pattern = Pattern(1, [[True, False, False], [True, True, False]])
+        >>> pattern.crop(1, 0, 2, 2).rows
+        [[False, False], [True, False]]
+        >>> pattern.crop(2, 0, 2, 2)
+        Traceback (most recent call last):
+            ...
+        ValueError: Crop 2x2 at (2, 0) is outside <Pattern #1 (3x2)>
+        '''
+        if not (0 <= x and 0 <= y and 0 < width and 0 < height
+                and x + width <= self.width and y + height <= self.height):
+            raise ValueError('Crop %sx%s at (%s, %s) is outside %r' % (width, height, x, y, self))
+
+        mask = _row_mask(width)
+
+        return self._transformed(width, [(row >> x) & mask
+                                         for row in self.packed_rows[y:y + height]])
+
+    def tile(self, across=1, down=1):
+        '''Repeat the pattern `across` times horizontally and `down` times
+        vertically
+
+        >>> pattern = Pattern(1, [[True, False], [True, True]])
+        >>> pattern.tile(2, 1).rows
+        [[True, False, True, False], [True, True, True, True]]
+        >>> pattern.tile(1, 2).rows
+        [[True, False], [True, True], [True, False], [True, True]]
+        >>> pattern.tile(0)
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot tile <Pattern #1 (2x2)> 0 across and 1 down
+        '''
+        if across < 1 or down < 1:
+            raise ValueError('Cannot tile %r %s across and %s down' % (self, across, down))
+
+        spread = sum(1 << (i * self.width) for i in range(across))
+
+        return self._transformed(self.width * across,
+                                 [row * spread for row in self.packed_rows] * down)
+
+    def repeat(self, width, height):
+        '''Fill `width` x `height` stitches by repeating the pattern from
+        the top left corner
+
+        >>> Pattern(1, [[True, False], [True, True]]).repeat(3, 3).rows
+        [[True, False, True], [True, True, True], [True, False, True]]
+        '''
+        across = -(-width // self.width)
+        down = -(-height // self.height)
+
+        return self.tile(across, down).crop(0, 0, width, height)
+
+    def _combine(self, other, op):
+        if (self.width, self.height) != (other.width, other.height):
+            raise ValueError('Cannot combine %r with %r of a different size' % (self, other))
+
+        return self._transformed(self.width, [op(a, b) for a, b in zip(self.packed_rows,
+                                                                       other.packed_rows)])
+
+    def __or__(self, other):
+        '''Stitches set in either pattern
+
+        >>> a = Pattern(1, [[True, False, False], [True, True, False]])
+        >>> b = Pattern(2, [[False, True, False], [False, True, True]])
+        >>> (a | b).rows
+        [[True, True, False], [True, True, True]]
+        >>> a | Pattern(2, [[True]])
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot combine <Pattern #1 (3x2)> with <Pattern #2 (1x1)> of a different size
+        '''
+        return self._combine(other, lambda a, b: a | b)
+
+    def __and__(self, other):
+        '''Stitches set in both patterns
+
+        >>> a = Pattern(1, [[True, False, False], [True, True, False]])
+        >>> b = Pattern(2, [[False, True, False], [False, True, True]])
+        >>> (a & b).rows
+        [[False, False, False], [False, True, False]]
+        '''
+        return self._combine(other, lambda a, b: a & b)
+
+    def __xor__(self, other):
+        '''Stitches set in exactly one of the patterns
+
+        >>> a = Pattern(1, [[True, False, False], [True, True, False]])
+        >>> b = Pattern(2, [[False, True, False], [False, True, True]])
+        >>> (a ^ b).rows
+        [[True, True, False], [True, False, True]]
+        '''
+        return self._combine(other, lambda a, b: a ^ b)
+
+    def _serialize_rows(self):
+        return _serialize_packed_rows(self.width, self.height, self.packed_rows)
 
     def serialize_header(self, offset):
         offset_bytes = struct.pack('>H', offset)
@@ -151,6 +430,11 @@ class Pattern(object):
     def serialize_data(self):
         return self._serialize_rows() + self.memo
 
+    def digest(self):
+        '''Hash of the encoded stitch data, comparable with the digests
+        returned by `pattern_digests`. The memo is not included.'''
+        return _pattern_digest(self.width, self.height, self._serialize_rows())
+
 
 class MachineState(object):
     SERIALIZED_PATTERN_LIST_LENGTH = 686
@@ -306,3 +590,163 @@ def parse_memory_dump(data):
                          data2)
 
     return state
+
+
+def pattern_digests(data):
+    '''Map pattern numbers to digests of the encoded stitch data in a
+    memory dump. Rows are re-encoded from packed rows, so padding bits do
+    not affect the digest, but never decoded to lists of stitches.'''
+    digests = {}
+
+    for i in range(PATTERN_COUNT):
+        location = _read_pattern_location(data, i)
+
+        if location:
+            width, height = location.width, location.height
+            packed_rows = _parse_packed_rows(width, height,
+                                             data[location.pattern_start:location.memo_start])
+
+            digests[location.pattern_number] = _pattern_digest(
+                width, height, _serialize_packed_rows(width, height, packed_rows))
+
+    return digests
+
+
+def _find_pattern(data, pattern_number):
+    for i in range(PATTERN_COUNT):
+        location = _read_pattern_location(data, i)
+
+        if location and location.pattern_number == pattern_number:
+            return i, location
+
+    return None, None
+
+
+def read_pattern_with_number(data, pattern_number):
+    '''Decode a single pattern from a memory dump, or None if the dump
+    does not contain it.'''
+    header_idx, _ = _find_pattern(data, pattern_number)
+
+    if header_idx is None:
+        return None
+
+    return _read_pattern(data, header_idx)
+
+
+def read_pattern_memo(data, pattern_number):
+    '''Read the memo values of one pattern in a memory dump, top row first'''
+    _, location = _find_pattern(data, pattern_number)
+
+    if location is None:
+        raise KeyError('Pattern %s not found' % pattern_number)
+
+    return _unpack_memo(location.height, str(data[location.memo_start:location.memo_end]))
+
+
+def write_pattern_memo(data, pattern_number, values):
+    '''Replace the memo values of one pattern in a memory dump.
+
+    `data` must be a mutable buffer such as a bytearray or a writable
+    mmap. Only the memo bytes of the pattern are written.'''
+    _, location = _find_pattern(data, pattern_number)
+
+    if location is None:
+        raise KeyError('Pattern %s not found' % pattern_number)
+
+    if len(values) != location.height:
+        raise ValueError('Expected %s memo values, got %s' % (location.height, len(values)))
+
+    # Odd heights leave the high nibble of the first byte unused, it is
+    # kept as the machine wrote it
+    pad_nibble = 0
+    if util.padding(location.height, 2):
+        pad_nibble = ord(str(data[location.memo_start:location.memo_start + 1])) >> 4
+
+    data[location.memo_start:location.memo_end] = _pack_memo(values, pad_nibble)
+
+
+def _invalid_bcd(nibbles):
+    return any(n > 9 for n in nibbles)
+
+
+def validate_memory_dump(data):
+    '''Check the structure of a memory dump without decoding any patterns.
+    Returns a list of problems found, empty if the dump looks sane.
+
+    `data` only needs to support `len` and slicing, so a memory map of a
+    dump file can be checked in place.'''
+    if len(data) != 32768:
+        return ['Expected 32768 bytes, got %s' % len(data)]
+
+    problems = []
+    pattern_area = (PATTERN_COUNT * 7, 0x7ee0)
+    ranges = []
+    numbers = set()
+    end_of_table = None
+
+    for i in range(PATTERN_COUNT):
+        header = data[i * 7:(i + 1) * 7]
+        end_offset = struct.unpack('>H', header[0:2])[0]
+
+        if not end_offset:
+            if end_of_table is None:
+                end_of_table = i
+            continue
+
+        if end_of_table is not None:
+            problems.append('Header %s follows the end of the pattern table at %s'
+                            % (i, end_of_table))
+
+        header_nibbles = list(util.to_nibbles(header[2:]))
+        if _invalid_bcd(header_nibbles[0:6] + header_nibbles[7:10]):
+            problems.append('Header %s has invalid BCD digits' % i)
+            continue
+
+        location = _read_pattern_location(data, i)
+
+        if not (901 <= location.pattern_number <= 998):
+            problems.append('Header %s has invalid pattern number %s'
+                            % (i, location.pattern_number))
+        elif location.pattern_number in numbers:
+            problems.append('Pattern %s appears more than once' % location.pattern_number)
+
+        numbers.add(location.pattern_number)
+
+        if not location.width or not location.height:
+            problems.append('Pattern %s is empty (%sx%s)'
+                            % (location.pattern_number, location.width, location.height))
+        elif (location.pattern_start < pattern_area[0]
+              or location.memo_end > pattern_area[1]):
+            problems.append('Pattern %s data at 0x%04x-0x%04x is outside the pattern area'
+                            % (location.pattern_number, location.pattern_start, location.memo_end))
+        else:
+            ranges.append((location.pattern_start, location.memo_end, location.pattern_number))
+
+    ranges.sort()
+    for (_, end, number), (start, _, next_number) in zip(ranges, ranges[1:]):
+        if start < end:
+            problems.append('Patterns %s and %s overlap' % (number, next_number))
+
+    pattern_count = PATTERN_COUNT if end_of_table is None else end_of_table
+    control_data = _read_control_data(data)
+
+    if control_data.header_end_ptr != 0x8000 - 7 * pattern_count - 7:
+        problems.append('Header end pointer 0x%04x does not match %s patterns'
+                        % (control_data.header_end_ptr, pattern_count))
+
+    pointer_range = (0x120, 0x8000 - MachineState.SERIALIZED_PATTERN_LIST_LENGTH + 1)
+
+    pointers = [('next pattern', control_data.next_pattern_ptr1)]
+    if pattern_count:
+        pointers += [('last pattern end', control_data.last_pattern_end_ptr),
+                     ('last pattern start', control_data.last_pattern_start_ptr)]
+
+    for name, pointer in pointers:
+        if not pointer_range[0] <= pointer <= pointer_range[1]:
+            problems.append('%s pointer 0x%04x is outside the pattern area'
+                            % (name.capitalize(), pointer))
+
+    if _invalid_bcd(list(util.to_nibbles(data[0x7fea:0x7fec]))[1:]):
+        problems.append('Loaded pattern number has invalid BCD digits')
+
+    return problems
@@ -2,18 +2,26 @@
 
 from os import path
 
+import atexit
 import click
 import os
 import re
 import sys
+import time
 
-from fdcemu import FDCServer, Disk
-from kh940 import MachineState, parse_memory_dump
+from fdcemu import FDCServer, Disk, DiskBanks, send_bank_switch
+from preview import render_pattern
+from profiling import NullProfiler, StageProfiler
+from recording import ReplayPort, ReplayMismatch, ReplayFinished, read_recording
+from kh940 import (MachineState, parse_memory_dump, pattern_digests, read_pattern_with_number,
+                   read_pattern_memo, write_pattern_memo)
 
 import bitmap
 
 IMAGE_RE = re.compile(r'9[0-9][0-9]\.(png|bmp|gif|jpe?g)')
 
+profiler = NullProfiler()
+
 
 def _machine_to_disk(machine):
     disk = Disk()
@@ -29,16 +37,6 @@ def _disk_to_machine(disk):
     return machine
 
 
-def _show_pattern(pattern):
-    print 'Pattern #%s: %sx%s' % (pattern.pattern_number, pattern.width, pattern.height)
-    print
-
-    for row in pattern.rows:
-        print ''.join('█' if b else '░' for b in row)
-
-    print
-
-
 def _machine_to_folder(state, folder):
     if not path.exists(folder):
         os.makedirs(folder)
@@ -47,19 +45,75 @@ def _machine_to_folder(state, folder):
         bitmap.write_pattern(pattern, path.join(folder, '%s.png' % pattern.pattern_number))
 
 
+def _folder_pattern_files(folder):
+    if not path.exists(folder):
+        return {}
+
+    return dict((int(f[:f.index('.')]), path.join(folder, f))
+                for f in os.listdir(folder) if IMAGE_RE.match(f))
+
+
 def _folder_to_machine(folder):
     if not path.exists(folder):
         return MachineState.make_empty()
 
-    patterns = [bitmap.read_pattern(path.join(folder, f))
-                for f in os.listdir(folder) if IMAGE_RE.match(f)]
+    patterns = [bitmap.read_pattern(filename)
+                for filename in _folder_pattern_files(folder).values()]
 
     return MachineState.with_patterns(patterns)
 
 
+def _image_to_disk(filename):
+    if path.getsize(filename) != 32768:
+        return Disk(filename)
+
+    with open(filename, 'rb') as f:
+        disk = Disk()
+        disk.set_concat_sector_data(f.read())
+
+    return disk
+
+
+def _read_machine_data(filename):
+    return _image_to_disk(filename).concat_sectors(32)
+
+
+def _load_bank(source):
+    if path.isdir(source):
+        return _machine_to_disk(_folder_to_machine(source))
+
+    return _image_to_disk(source)
+
+
+def _diff_patterns(folder_digests, machine_digests):
+    changed = sorted(n for n in folder_digests
+                     if n in machine_digests and folder_digests[n] != machine_digests[n])
+
+    added = set(folder_digests) - set(machine_digests)
+    removed = set(machine_digests) - set(folder_digests)
+
+    renumbered = []
+    for old_number in sorted(removed):
+        for new_number in sorted(added):
+            if machine_digests[old_number] == folder_digests[new_number]:
+                renumbered.append((old_number, new_number))
+                added.remove(new_number)
+                removed.remove(old_number)
+                break
+
+    return sorted(added), sorted(removed), changed, renumbered
+
+
 @click.group()
-def cli():
-    pass
+@click.option('--profile', is_flag=True, envvar='KNITTY_GRITTY_PROFILE')
+@click.option('--profile-memory', is_flag=True, envvar='KNITTY_GRITTY_PROFILE_MEMORY')
+@click.option('--profile-dir', default=None, envvar='KNITTY_GRITTY_PROFILE_DIR')
+def cli(profile, profile_memory, profile_dir):
+    global profiler
+
+    if profile or profile_memory or profile_dir:
+        profiler = StageProfiler(memory=profile_memory, cprofile_dir=profile_dir)
+        atexit.register(profiler.print_summary)
 
 
 @cli.command('emulate-folder')
@@ -67,37 +121,293 @@ def cli():
 @click.argument('folder')
 @click.option('--save/--no-save', 'save_on_exit', default=True, is_flag=True)
 @click.option('--save-raw', is_flag=True)
-def emulate_folder(port, folder, save_on_exit, save_raw):
+@click.option('--record', 'record_filename', default=None)
+@click.option('--preview/--no-preview', default=True)
+@click.option('--preview-size', default=40, type=int)
+def emulate_folder(port, folder, save_on_exit, save_raw, record_filename,
+                   preview, preview_size):
     if not path.exists(port):
         print 'ERROR: Port %s not found - is the cable connected?' % port
         sys.exit(1)
 
-    machine = _folder_to_machine(folder)
+    with profiler.stage('load'):
+        machine = _folder_to_machine(folder)
 
     print 'Loaded %s patterns:' % len(machine.patterns)
 
-    for pattern in machine.patterns:
-        _show_pattern(pattern)
+    if preview:
+        with profiler.stage('preview'):
+            for pattern in machine.patterns:
+                sys.stdout.write(render_pattern(pattern, preview_size))
+
+    with profiler.stage('encode'):
+        disk = _machine_to_disk(machine)
 
-    disk = _machine_to_disk(machine)
-    server = FDCServer(port, disk)
+    server = FDCServer(port, disk, record_filename)
 
     try:
         print 'Emulator started, press Ctrl-C to quit'
-        server.run()
+
+        with profiler.stage('serve'):
+            server.run()
     except KeyboardInterrupt:
         if save_on_exit:
             print 'Saving images...'
-            new_machine = _disk_to_machine(disk)
-            _machine_to_folder(new_machine, folder)
+
+            with profiler.stage('parse'):
+                new_machine = _disk_to_machine(disk)
+
+            with profiler.stage('save'):
+                _machine_to_folder(new_machine, folder)
 
         if save_raw:
             print 'Saving 32kb raw data to %s...' % (folder + '.raw')
-            with open(folder + '.raw', 'wb') as f:
-                f.write(disk.concat_sectors(32))
+
+            with profiler.stage('save-raw'):
+                with open(folder + '.raw', 'wb') as f:
+                    f.write(disk.concat_sectors(32))
     finally:
         server.close()
 
 
+@cli.command('emulate-banks')
+@click.argument('port')
+@click.argument('sources', nargs=-1)
+@click.option('--control-port', default=9400, type=int)
+@click.option('--record', 'record_filename', default=None)
+def emulate_banks(port, sources, control_port, record_filename):
+    if not path.exists(port):
+        print 'ERROR: Port %s not found - is the cable connected?' % port
+        sys.exit(1)
+
+    if not sources:
+        print 'ERROR: No pattern folders or images given'
+        sys.exit(1)
+
+    names = [path.basename(path.normpath(source)) for source in sources]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+
+    if duplicates:
+        print 'ERROR: Bank names must be unique, rename the folders or files for: %s' % (
+            ', '.join(duplicates))
+        sys.exit(1)
+
+    banks = []
+    for name, source in zip(names, sources):
+        with profiler.stage('load'):
+            banks.append((name, _load_bank(source)))
+
+        print 'Loaded bank %s from %s' % (name, source)
+
+    server = FDCServer(port, banks[0][1], record_filename)
+    disk_banks = DiskBanks(server, banks)
+
+    try:
+        disk_banks.serve_control(control_port)
+
+        print 'Serving bank %s, switch with `knitty-gritty switch-bank NAME`' % disk_banks.active
+        print 'Emulator started, press Ctrl-C to quit'
+
+        with profiler.stage('serve'):
+            server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+@cli.command('switch-bank')
+@click.argument('name')
+@click.option('--control-port', default=9400, type=int)
+def switch_bank(name, control_port):
+    # socket.error is an IOError
+    try:
+        response = send_bank_switch(name, control_port)
+    except IOError:
+        print 'ERROR: No emulator listening on port %s' % control_port
+        sys.exit(1)
+
+    print response
+
+    if not response.startswith('OK'):
+        sys.exit(1)
+
+
+@cli.command('replay')
+@click.argument('recording')
+@click.option('--realtime', is_flag=True)
+def replay(recording, realtime):
+    with profiler.stage('load'):
+        try:
+            replay_port = ReplayPort(read_recording(recording), realtime)
+            server = FDCServer(replay_port, Disk())
+            replay_port.attach(server)
+        except ValueError as e:
+            print 'ERROR: %s' % e
+            sys.exit(1)
+
+    start = time.time()
+
+    try:
+        with profiler.stage('serve'):
+            server.run()
+    except ReplayFinished:
+        pass
+    except ReplayMismatch as e:
+        print 'ERROR: %s' % e
+        sys.exit(1)
+
+    elapsed = time.time() - start
+
+    print 'Replayed %s bytes in, %s bytes out in %.2fs (%.0f bytes/s)' % (
+        replay_port.bytes_read, replay_port.bytes_written, elapsed,
+        (replay_port.bytes_read + replay_port.bytes_written) / max(elapsed, 1e-6))
+
+
+@cli.command('verify')
+@click.argument('paths', nargs=-1)
+@click.option('--roundtrip/--no-roundtrip', default=True)
+@click.option('--jobs', default=None, type=int)
+def verify(paths, roundtrip, jobs):
+    from verify import find_dumps, verify_dumps
+
+    failed = 0
+    total = 0
+
+    with profiler.stage('verify'):
+        for filename, problems in verify_dumps(list(find_dumps(paths)), roundtrip, jobs):
+            total += 1
+
+            if problems:
+                failed += 1
+                print 'FAIL %s' % filename
+
+                for problem in problems:
+                    print '    %s' % problem
+            else:
+                print 'OK   %s' % filename
+
+    print '%s of %s dumps passed' % (total - failed, total)
+
+    if failed:
+        sys.exit(1)
+
+
+@cli.command('memo')
+@click.argument('dump')
+@click.argument('pattern_number', type=int)
+@click.argument('edits', nargs=-1)
+def memo(dump, pattern_number, edits):
+    import mmap
+
+    if not path.isfile(dump):
+        print 'ERROR: Dump %s not found' % dump
+        sys.exit(1)
+
+    # Disk images hold the memory under a different layout, only raw
+    # memory dumps can be edited in place
+    if path.getsize(dump) != 32768:
+        print 'ERROR: %s is not a 32768 byte memory dump' % dump
+        sys.exit(1)
+
+    try:
+        with open(dump, 'r+b' if edits else 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0,
+                             access=mmap.ACCESS_WRITE if edits else mmap.ACCESS_READ)
+    except (IOError, OSError) as e:
+        print 'ERROR: Could not open dump %s: %s' % (dump, e)
+        sys.exit(1)
+
+    try:
+        values = read_pattern_memo(data, pattern_number)
+
+        for edit in edits:
+            if edit.count('=') != 1:
+                raise ValueError('Expected ROW=VALUE, got %s' % edit)
+
+            row, value = edit.split('=')
+            row, value = int(row), int(value, 16)
+
+            if not 0 <= row < len(values):
+                raise IndexError('Row %s is outside pattern %s' % (row, pattern_number))
+
+            values[row] = value
+
+        if edits:
+            write_pattern_memo(data, pattern_number, values)
+            data.flush()
+    except (KeyError, ValueError, IndexError) as e:
+        print 'ERROR: %s' % (e.args[0] if e.args else e)
+        sys.exit(1)
+    except EnvironmentError as e:
+        print 'ERROR: Could not write dump %s: %s' % (dump, e)
+        sys.exit(1)
+    finally:
+        data.close()
+
+    print 'Pattern #%s memo: %s' % (pattern_number, ''.join('%X' % v for v in values))
+
+
+@cli.command('diff')
+@click.argument('folder')
+@click.argument('image')
+@click.option('--sync', is_flag=True)
+def diff(folder, image, sync):
+    if not path.isfile(image):
+        print 'ERROR: Image %s not found' % image
+        sys.exit(1)
+
+    try:
+        data = _read_machine_data(image)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        print 'ERROR: Could not read image %s: %s' % (image, e)
+        sys.exit(1)
+    files = _folder_pattern_files(folder)
+
+    with profiler.stage('load'):
+        folder_digests = dict((n, bitmap.read_pattern(f).digest()) for n, f in files.items())
+
+    with profiler.stage('hash-dump'):
+        machine_digests = pattern_digests(data)
+
+    added, removed, changed, renumbered = _diff_patterns(folder_digests, machine_digests)
+
+    for n in added:
+        print 'A %s' % n
+    for n in removed:
+        print 'D %s' % n
+    for n in changed:
+        print 'M %s' % n
+    for old_number, new_number in renumbered:
+        print 'R %s -> %s' % (old_number, new_number)
+
+    if not (added or removed or changed or renumbered):
+        print 'Folder and image contain the same patterns'
+
+    if not sync:
+        return
+
+    with profiler.stage('save'):
+        for old_number, new_number in renumbered:
+            extension = path.splitext(files[new_number])[1]
+            os.rename(files[new_number], path.join(folder, '%s%s' % (old_number, extension)))
+
+        for n in changed:
+            filename = path.join(folder, '%s.png' % n)
+            bitmap.write_pattern(read_pattern_with_number(data, n), filename)
+
+            if files[n] != filename:
+                os.remove(files[n])
+
+        if removed and not path.exists(folder):
+            os.makedirs(folder)
+
+        for n in removed:
+            bitmap.write_pattern(read_pattern_with_number(data, n), path.join(folder, '%s.png' % n))
+
+    if added:
+        print 'Left %s pattern(s) only present in the folder untouched' % len(added)
+
+
 if __name__ == '__main__':
     cli()
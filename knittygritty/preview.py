@@ -0,0 +1,58 @@
+# -*- encoding: utf8 -*-
+
+import math
+
+# (top stitch, bottom stitch) -> glyph
+HALF_BLOCKS = {
+    (False, False): ' ',
+    (True, False): '▀',
+    (False, True): '▄',
+    (True, True): '█',
+}
+
+
+def _downsample(rows, scale):
+    '''Shrink rows by `scale` in both directions, setting each cell if
+    at least half of the stitches it covers are set'''
+    if scale == 1:
+        return rows
+
+    width = len(rows[0])
+    sampled = []
+
+    for y in range(0, len(rows), scale):
+        block = rows[y:y + scale]
+        row = []
+
+        for x in range(0, width, scale):
+            count = sum(sum(r[x:x + scale]) for r in block)
+            cells = len(block) * len(block[0][x:x + scale])
+
+            row.append(count * 2 >= cells)
+
+        sampled.append(row)
+
+    return sampled
+
+
+def render_pattern(pattern, size=None):
+    '''Render a pattern as text, two stitch rows per line. If `size` is
+    given, the pattern is scaled down to fit within `size` stitches in
+    both directions, giving at most `size` columns and `size / 2` lines.'''
+    scale = 1
+    if size:
+        scale = max(1, int(math.ceil(max(pattern.width, pattern.height) / float(size))))
+
+    rows = _downsample(pattern.rows, scale)
+
+    if len(rows) % 2:
+        rows = rows + [[False] * len(rows[0])]
+
+    lines = ['Pattern #%s: %sx%s' % (pattern.pattern_number, pattern.width, pattern.height), '']
+
+    for top, bottom in zip(rows[::2], rows[1::2]):
+        lines.append(''.join(HALF_BLOCKS[cell] for cell in zip(top, bottom)))
+
+    lines += ['', '']
+
+    return '\n'.join(lines)
@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+from os import path
+
+import os
+import sys
+import time
+
+
+class NullProfiler(object):
+    '''Stand-in used when profiling is off. `stage` hands back one shared
+    context manager that does nothing.'''
+
+    class _NullStage(object):
+        def __enter__(self):
+            pass
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    _null_stage = _NullStage()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def print_summary(self):
+        pass
+
+
+def _max_rss():
+    import resource
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on OS X, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return max_rss
+
+    return max_rss * 1024
+
+
+class StageProfiler(object):
+    '''Times named pipeline stages, optionally recording memory use and a
+    cProfile dump per stage.
+
+    Memory is the peak allocated in each stage when `tracemalloc` is
+    installed. Otherwise it is the process' maximum resident set size at
+    the end of each stage, which only grows over the run.'''
+
+    def __init__(self, memory=False, cprofile_dir=None):
+        self.tracemalloc = None
+        self.memory_label = None
+
+        if memory:
+            try:
+                import tracemalloc
+                self.tracemalloc = tracemalloc
+                self.memory_label = 'peak (kB)'
+            except ImportError:
+                try:
+                    _max_rss()
+                    self.memory_label = 'max RSS (kB)'
+                except ImportError:
+                    print ('WARNING: Neither tracemalloc nor resource is available, '
+                           'not profiling memory')
+
+        self.cprofile_dir = cprofile_dir
+
+        self.order = []
+        self.calls = {}
+        self.times = {}
+        self.peaks = {}
+        self.profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        if name not in self.calls:
+            self.order.append(name)
+            self.calls[name] = 0
+            self.times[name] = 0.0
+            self.peaks[name] = 0
+
+        if self.tracemalloc:
+            self.tracemalloc.start()
+
+        if self.cprofile_dir:
+            import cProfile
+
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - start
+            self.calls[name] += 1
+
+            if self.cprofile_dir:
+                profile.disable()
+
+            if self.tracemalloc:
+                self.peaks[name] = max(self.peaks[name], self.tracemalloc.get_traced_memory()[1])
+                self.tracemalloc.stop()
+            elif self.memory_label:
+                self.peaks[name] = max(self.peaks[name], _max_rss())
+
+    def print_summary(self):
+        if not self.order:
+            return
+
+        if self.cprofile_dir:
+            if not path.exists(self.cprofile_dir):
+                os.makedirs(self.cprofile_dir)
+
+            for name, profile in self.profiles.items():
+                profile.dump_stats(path.join(self.cprofile_dir, '%s.prof' % name))
+
+        print
+        header = '%-10s %5s %10s' % ('stage', 'calls', 'time (s)')
+
+        if self.memory_label:
+            header += ' %13s' % self.memory_label
+
+        print header
+
+        for name in self.order:
+            line = '%-10s %5s %10.3f' % (name, self.calls[name], self.times[name])
+
+            if self.memory_label:
+                line += ' %13.1f' % (self.peaks[name] / 1024.0)
+
+            print line
@@ -0,0 +1,265 @@
+import struct
+import time
+
+MAGIC = 'KGREC3'
+
+DIR_READ = 'R'
+DIR_WRITE = 'W'
+DIR_DISK = 'D'
+
+# direction, microseconds since the previous record (64 bit), data length
+RECORD_HEADER = struct.Struct('>cQI')
+
+MAX_RECORD_LENGTH = 0xffff
+
+
+def _preview(data, length=16):
+    if len(data) > length:
+        return repr(data[:length]) + '...'
+
+    return repr(data)
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+class ReplayFinished(EOFError):
+    pass
+
+
+def read_recording(filename):
+    '''Read a recording into a list of (direction, timestamp, data) tuples,
+    with timestamps in seconds from the start of the session'''
+    records = []
+    timestamp = 0
+
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a knitty-gritty recording' % filename)
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                break
+
+            direction, delta, length = RECORD_HEADER.unpack(header)
+            timestamp += delta / 1000000.0
+
+            records.append((direction, timestamp, f.read(length)))
+
+    return records
+
+
+class RecordingPort(object):
+    '''Wraps a serial port and logs all bytes passing through it.
+
+    Consecutive bytes in the same direction are coalesced into one record,
+    timestamped with the arrival of the first byte. The disk being served
+    is stored whenever it changes, so a recording replays on its own.
+    Failing to write the recording stops recording but never interrupts
+    the session.'''
+
+    def __init__(self, port, filename):
+        self.port = port
+        self.f = open(filename, 'wb')
+        self.f.write(MAGIC)
+
+        self.last_time = None
+        self.pending_direction = None
+        self.pending_time = None
+        self.pending_data = ''
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def read(self, size=1):
+        data = self.port.read(size)
+
+        if data:
+            self._log(DIR_READ, data)
+
+        return data
+
+    def write(self, data):
+        self._log(DIR_WRITE, data)
+        self.port.write(data)
+
+    def close(self):
+        self._flush()
+
+        if self.f:
+            try:
+                self.f.close()
+            except (IOError, OSError) as e:
+                print 'WARNING: Could not write recording: %s' % e
+
+        self.port.close()
+
+    def log_disk(self, disk_data):
+        self._flush()
+
+        self.pending_direction = DIR_DISK
+        self.pending_time = time.time()
+        self.pending_data = disk_data
+
+        self._flush()
+        self.pending_direction = None
+
+    def _stop_recording(self, error):
+        print 'WARNING: Could not write recording, recording stopped: %s' % error
+
+        try:
+            self.f.close()
+        except (IOError, OSError):
+            pass
+
+        self.f = None
+
+    def _log(self, direction, data):
+        if not self.f:
+            return
+
+        if (direction != self.pending_direction
+                or len(self.pending_data) + len(data) > MAX_RECORD_LENGTH):
+            self._flush()
+
+            self.pending_direction = direction
+            self.pending_time = time.time()
+
+        self.pending_data += data
+
+    def _flush(self):
+        if not self.f or not self.pending_data:
+            return
+
+        if self.last_time is None:
+            self.last_time = self.pending_time
+
+        # The clock may step backwards, deltas are clamped to zero
+        delta = max(0, int(round((self.pending_time - self.last_time) * 1000000)))
+        self.last_time = self.pending_time
+
+        try:
+            self.f.write(RECORD_HEADER.pack(self.pending_direction, delta, len(self.pending_data)))
+            self.f.write(self.pending_data)
+        except (IOError, OSError, struct.error) as e:
+            self._stop_recording(e)
+
+        self.pending_data = ''
+
+
+class ReplayPort(object):
+    '''Stands in for the serial port when replaying a recording.
+
+    Bytes the machine sent are handed out by `read`, and everything the
+    emulator writes is checked against what it answered in the recording.
+    Disks stored in the recording are loaded into the attached server as
+    they are reached. With `realtime` set, reads are delayed to match the
+    recorded timing.'''
+
+    def __init__(self, records, realtime=False):
+        self.records = records
+        self.realtime = realtime
+
+        self.index = 0
+        self.offset = 0
+        self.start_time = None
+
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        self.server = None
+
+    def attach(self, server):
+        '''Serve through `server`, loading the disk the recording starts with'''
+        if not self.records or self.records[0][0] != DIR_DISK:
+            raise ValueError('Recording does not start with a disk image')
+
+        self.server = server
+        self._current()
+
+    def setRTS(self, level):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def finished(self):
+        return self.index >= len(self.records)
+
+    def _current(self):
+        while not self.finished:
+            direction, timestamp, data = self.records[self.index]
+
+            if direction == DIR_DISK:
+                from fdcemu import Disk
+
+                self.server.set_disk(Disk.from_bytes(data))
+                self.index += 1
+                continue
+
+            if self.offset < len(data):
+                return direction, timestamp, data
+
+            self.index += 1
+            self.offset = 0
+
+        return None, None, None
+
+    def read(self, size=1):
+        direction, timestamp, data = self._current()
+
+        if direction is None:
+            raise ReplayFinished()
+
+        if direction != DIR_READ:
+            raise ReplayMismatch('Emulator read at record %s, expected it to write %s'
+                                 % (self.index, _preview(data[self.offset:])))
+
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = time.time() - timestamp
+
+            delay = self.start_time + timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        chunk = data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        self.bytes_read += len(chunk)
+
+        # A disk switch recorded right after this read must be in place
+        # before the emulator acts on what it just read
+        self._current()
+
+        return chunk
+
+    def write(self, written):
+        remaining = written
+
+        while remaining:
+            direction, timestamp, data = self._current()
+
+            if direction is None:
+                raise ReplayMismatch('Emulator wrote %s after the end of the recording'
+                                     % _preview(remaining))
+
+            if direction != DIR_WRITE:
+                raise ReplayMismatch('Emulator wrote %s at record %s, expected it to read'
+                                     % (_preview(remaining), self.index))
+
+            expected = data[self.offset:self.offset + len(remaining)]
+
+            if not remaining.startswith(expected):
+                diff_pos = next(i for i, (a, b) in enumerate(zip(remaining, expected)) if a != b)
+
+                raise ReplayMismatch('Emulator wrote %s at record %s byte %s, recording has %s'
+                                     % (_preview(remaining[diff_pos:]), self.index,
+                                        self.offset + diff_pos, _preview(expected[diff_pos:])))
+
+            self.offset += len(expected)
+            remaining = remaining[len(expected):]
+
+        self.bytes_written += len(written)
@@ -0,0 +1,84 @@
+from os import path
+
+import mmap
+import os
+
+from kh940 import parse_memory_dump, validate_memory_dump
+
+
+def find_dumps(paths):
+    for p in paths:
+        if not path.isdir(p):
+            yield p
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(p):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                if filename.endswith('.raw'):
+                    yield path.join(dirpath, filename)
+
+
+def verify_dump(filename, roundtrip=True):
+    '''Validate a single dump file, returning (filename, problems)'''
+    try:
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return filename, ['File is empty']
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError) as e:
+        return filename, [str(e)]
+
+    try:
+        problems = validate_memory_dump(data)
+
+        if roundtrip and not problems:
+            contents = data[:]
+
+            try:
+                serialized = parse_memory_dump(contents).serialize()
+            except Exception as e:
+                problems.append('Could not parse dump: %s: %s' % (e.__class__.__name__, e))
+            else:
+                if serialized != contents:
+                    first_diff = next(i for i, (a, b) in enumerate(zip(serialized, contents))
+                                      if a != b)
+                    problems.append('Round trip differs, first at byte 0x%04x' % first_diff)
+    finally:
+        data.close()
+
+    return filename, problems
+
+
+def _verify_dump_roundtrip(filename):
+    return verify_dump(filename, True)
+
+
+def _verify_dump_structure(filename):
+    return verify_dump(filename, False)
+
+
+def verify_dumps(filenames, roundtrip=True, processes=None):
+    '''Validate dump files across a process pool, yielding
+    (filename, problems) in the order the files were given. With a
+    single process the files are checked in this process.'''
+    worker = _verify_dump_roundtrip if roundtrip else _verify_dump_structure
+
+    if processes == 1:
+        for filename in filenames:
+            yield worker(filename)
+
+        return
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for result in pool.imap(worker, filenames, chunksize=16):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
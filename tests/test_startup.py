@@ -0,0 +1,96 @@
+'''Startup regression tests for the command line tool.
+
+The CLI is run in a fresh interpreter for `--help` and the offline commands,
+checking that heavy dependencies stay unimported and that the wall time,
+including interpreter startup, stays within budget. The commands took about
+40 ms each when the budget was set.
+'''
+
+from os import path
+
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from knittygritty.kh940 import MachineState, Pattern
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+BUDGET_SECONDS = 0.15
+
+HEAVY_MODULES = ['PIL', 'serial', 'multiprocessing', 'socket']
+
+RUN_AND_LIST_MODULES = '''
+import json
+import sys
+
+sys.argv = ['knitty-gritty'] + json.loads(sys.argv[1])
+
+from knittygritty.main import cli
+
+try:
+    cli()
+except SystemExit:
+    pass
+
+print
+print json.dumps(sorted(set(m.split('.')[0] for m in sys.modules)))
+'''
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.folder = path.join(self.tmpdir, 'patterns')
+        self.dump = path.join(self.tmpdir, 'patterns.raw')
+
+        machine = MachineState.with_patterns([Pattern(901, [[True, False]] * 3)])
+
+        with open(self.dump, 'wb') as f:
+            f.write(machine.serialize())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _loaded_modules(self, args):
+        output = subprocess.check_output([sys.executable, '-c', RUN_AND_LIST_MODULES,
+                                          json.dumps(args)], cwd=ROOT)
+
+        return json.loads(output.strip().splitlines()[-1])
+
+    def _wall_time(self, args):
+        times = []
+
+        for i in range(3):
+            start = time.time()
+            subprocess.check_output([sys.executable, '-m', 'knittygritty.main'] + args, cwd=ROOT)
+            times.append(time.time() - start)
+
+        return min(times)
+
+    def _check_startup(self, args):
+        loaded = self._loaded_modules(args)
+
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, loaded, '%s imported by %s' % (module, ' '.join(args)))
+
+        wall_time = self._wall_time(args)
+        self.assertLess(wall_time, BUDGET_SECONDS,
+                        '%s took %.3fs' % (' '.join(args), wall_time))
+
+    def test_help(self):
+        self._check_startup(['--help'])
+
+    def test_diff(self):
+        self._check_startup(['diff', self.folder, self.dump])
+
+    def test_verify(self):
+        self._check_startup(['verify', '--jobs', '1', self.dump])
+
+
+if __name__ == '__main__':
+    unittest.main()